@@ -1,19 +1,57 @@
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi import FastAPI, HTTPException, status
+from fastapi.responses import StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
 
+import os
 import json
+import time
+import heapq
+import asyncio
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import httpx
+import numpy as np
 from sentence_transformers import SentenceTransformer
 from flashrank import Ranker, RerankRequest
 from usearch.index import Index
 
-from utils import transform_query
+from utils import MetadataFilter, dense_search, metadata_mask, transform_query
 
-index = Index.restore("/app/data/indexes/index.usearch")
-chunks = json.load(open("/app/data/chunked/chunks.json", "r"))
-model = SentenceTransformer("/app/models/mxbai-embed-large-v1")
-ranker = Ranker()
+SEARCH_COUNT = 30
+MAX_EXPANSION_SEARCH = 1024
+## Comma separated shard server URLs, see shard.py; empty to search a local index
+SHARD_URLS = [url for url in os.environ.get("SHARD_URLS", "").split(",") if url]
+
+WARMUP_QUERY = "How do I report a power outage?"
+
+## Milliseconds spent on each startup step, reported by /ready
+startup_timings: Dict[str, float] = {}
+
+
+def timed(step: str, load: Callable[[], Any]) -> Any:
+    start = time.perf_counter()
+    value = load()
+    startup_timings[step] = round((time.perf_counter() - start) * 1000, 3)
+    return value
+
+
+## Everything below is loaded once at import. Under gunicorn (see gunicorn.conf.py)
+## that happens in the parent process, and workers share it copy-on-write. Nothing
+## here may start a thread pool, since threads don't survive the fork.
+if SHARD_URLS:
+    shard_client = httpx.AsyncClient(timeout=30.0)
+else:
+    ## view=True memory-maps the index, so its pages are shared through the page cache
+    index = timed("index", lambda: Index.restore("/app/data/indexes/index.usearch", view=True))
+    embeddings = timed(
+        "embeddings", lambda: np.load("/app/data/embeddings/embeddings.npy", mmap_mode="r")
+    )
+    embedding_norms = timed("embedding_norms", lambda: np.linalg.norm(embeddings, axis=1))
+    metadata = timed("metadata", lambda: dict(np.load("/app/data/indexes/index.meta.npz")))
+    chunks = timed("chunks", lambda: json.load(open("/app/data/chunked/chunks.json", "r")))
+model = timed("model", lambda: SentenceTransformer("/app/models/mxbai-embed-large-v1"))
+## The reranker's ONNX session starts its own thread pool, so each worker creates it on startup
+ranker: Optional[Ranker] = None
 
 app = FastAPI(docs_url="/")
 app.add_middleware(
@@ -25,10 +63,85 @@ app.add_middleware(
 )
 
 
-class RagQuery(BaseModel):
+class RagQuery(MetadataFilter):
     query: str
 
 
+def local_search(
+    query_embedding: np.ndarray, expansion_search: Optional[int], query: RagQuery
+) -> Tuple[List[Dict], Dict]:
+    """
+    Search the index loaded in this process.
+
+    Returns:
+        Tuple[List[Dict], Dict]: candidates with id, chunk_id, distance and text, and a description of the search.
+    """
+    mask = metadata_mask(metadata, **query.model_dump(include=set(MetadataFilter.model_fields)))
+    results, search_info = dense_search(
+        index,
+        embeddings,
+        embedding_norms,
+        query_embedding,
+        SEARCH_COUNT,
+        expansion_search=expansion_search,
+        mask=mask,
+    )
+    candidates = [
+        {
+            "id": key,
+            "chunk_id": chunks[key]["chunk_id"],
+            "distance": distance,
+            "text": chunks[key]["chunk_text"],
+        }
+        for key, distance in results
+    ]
+    return candidates, search_info
+
+
+async def scatter_search(
+    query_embedding: np.ndarray, expansion_search: Optional[int], query: RagQuery
+) -> Tuple[List[Dict], Dict]:
+    """
+    Query every shard server in parallel and merge their candidates by distance.
+
+    Returns:
+        Tuple[List[Dict], Dict]: candidates with id, chunk_id, distance and text, and a description of the search.
+    """
+    start = time.perf_counter()
+    payload = {
+        "embedding": query_embedding.tolist(),
+        "count": SEARCH_COUNT,
+        "expansion_search": expansion_search,
+        **query.model_dump(mode="json", include=set(MetadataFilter.model_fields)),
+    }
+    responses = await asyncio.gather(
+        *[shard_client.post(f"{url}/search/", json=payload) for url in SHARD_URLS]
+    )
+    for response in responses:
+        response.raise_for_status()
+    bodies = [response.json() for response in responses]
+    merged = heapq.nsmallest(
+        SEARCH_COUNT,
+        (result for body in bodies for result in body["results"]),
+        key=lambda result: result["distance"],
+    )
+    candidates = [
+        {
+            "id": result["key"],
+            "chunk_id": result["chunk_id"],
+            "distance": result["distance"],
+            "text": result["chunk_text"],
+        }
+        for result in merged
+    ]
+    search_info = {
+        "method": "sharded",
+        "shards": [body["search"] for body in bodies],
+        "search_ms": round((time.perf_counter() - start) * 1000, 3),
+    }
+    return candidates, search_info
+
+
 @app.post("/embed/")
 async def query(query: RagQuery):
     try:
@@ -43,9 +156,7 @@ async def query(query: RagQuery):
         ) from e
 
 
-@app.post("/retrieve/")
-async def query(query: RagQuery, k: int = 5):
-    
+def check_retrieve_params(k: int, expansion_search: Optional[int]) -> None:
     if k <= 3:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -56,35 +167,169 @@ async def query(query: RagQuery, k: int = 5):
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="k must be at most 10",
         )
+    if expansion_search is not None and not (
+        SEARCH_COUNT <= expansion_search <= MAX_EXPANSION_SEARCH
+    ):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"expansion_search must be between {SEARCH_COUNT} and {MAX_EXPANSION_SEARCH}",
+        )
+
+
+async def retrieve_candidates(
+    query: RagQuery, expansion_search: Optional[int]
+) -> Tuple[List[Dict], Dict]:
+    """
+    Embed the query and run the dense search, locally or across the shards.
+
+    Returns:
+        Tuple[List[Dict], Dict]: candidates sorted by distance, and a description of the search.
+
+    Raises:
+        ValueError: If the query can't be embedded, or an unfiltered search finds nothing.
+    """
+    query_embedding = model.encode([transform_query(query.query)]).squeeze(0)
+    if query_embedding is None:
+        raise ValueError("query embedding is None")
+
+    if SHARD_URLS:
+        candidates, search_info = await scatter_search(
+            query_embedding, expansion_search, query
+        )
+    else:
+        candidates, search_info = local_search(query_embedding, expansion_search, query)
+
+    filtered = any(query.model_dump(include=set(MetadataFilter.model_fields)).values())
+    if not candidates and not filtered:
+        raise ValueError("no search results")
+    return candidates, search_info
+
+
+def rerank(query: RagQuery, candidates: List[Dict]) -> List[Dict]:
+    """
+    Rerank the dense candidates with FlashRank.
+
+    Returns:
+        List[Dict]: the candidates in reranked order, with a "score" key added.
+    """
+    if not candidates:
+        return []
+    by_id = {candidate["id"]: candidate for candidate in candidates}
+    reranker_batch = [
+        {
+            "id": candidate["id"],
+            "text": candidate["text"],
+            "meta": {},
+        }
+        for candidate in candidates
+    ]
+    rerank_req = RerankRequest(query=query.query, passages=reranker_batch)
+    res = ranker.rerank(rerank_req)
+    if res is None:
+        raise ValueError("rerank results are None")
+    return [{**by_id[result["id"]], "score": float(result["score"])} for result in res]
+
+
+def stream_result(candidate: Dict) -> Dict:
+    result = {
+        "id": candidate["id"],
+        "chunk_id": candidate["chunk_id"],
+        "text": candidate["text"],
+        "dense_score": 1.0 - candidate["distance"],
+    }
+    if "score" in candidate:
+        result["rerank_score"] = candidate["score"]
+    return result
+
+
+@app.post("/retrieve/")
+async def query(query: RagQuery, k: int = 5, expansion_search: Optional[int] = None):
+    check_retrieve_params(k, expansion_search)
     try:
-        query_embedding = model.encode([transform_query(query.query)]).squeeze(0)
-        if query_embedding is None:
-            raise ValueError("query embedding is None")
-
-        results = index.search(query_embedding, count=30)
-        if results is None:
-            raise ValueError("search results are None")
-
-        ids = [r[0] for r in results.to_list()]
-        if not ids:
-            raise ValueError("no search results")
-
-        reranker_batch = [
-            {
-                "id": i,
-                "text": chunks[i]["chunk_text"],
-                "meta": {},
-            }
-            for i in ids
-        ]
-        rerank_req = RerankRequest(query=query.query, passages=reranker_batch)
-        res = ranker.rerank(rerank_req)
-        results_ = [result["text"] for result in res[:k]]
-        if results_ is None:
-            raise ValueError("search results are None")
-        return {"results": results_}
+        candidates, search_info = await retrieve_candidates(query, expansion_search)
+        results_ = [result["text"] for result in rerank(query, candidates)[:k]]
+        return {"results": results_, "search": search_info}
     except Exception as e:
         error_message = "Internal Server Error: {}: {}".format(type(e).__name__, str(e))
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=error_message
         ) from e
+
+
+@app.post("/retrieve/stream/")
+async def query(query: RagQuery, k: int = 5, expansion_search: Optional[int] = None):
+    """
+    Streaming variant of /retrieve/, as newline delimited JSON. The dense top-k
+    is sent as soon as the search returns ("stage": "dense"), followed by the
+    reranked top-k ("stage": "reranked"). Errors after the stream has started
+    are sent as a final "stage": "error" line.
+    """
+    check_retrieve_params(k, expansion_search)
+
+    async def stages():
+        start = time.perf_counter()
+        try:
+            candidates, search_info = await retrieve_candidates(query, expansion_search)
+            yield json.dumps(
+                {
+                    "stage": "dense",
+                    "results": [stream_result(c) for c in candidates[:k]],
+                    "search": search_info,
+                    "elapsed_ms": round((time.perf_counter() - start) * 1000, 3),
+                }
+            ) + "\n"
+            ## Rerank off the event loop so the dense line is flushed meanwhile
+            reranked = await asyncio.to_thread(rerank, query, candidates)
+            yield json.dumps(
+                {
+                    "stage": "reranked",
+                    "results": [stream_result(c) for c in reranked[:k]],
+                    "elapsed_ms": round((time.perf_counter() - start) * 1000, 3),
+                }
+            ) + "\n"
+        except Exception as e:
+            error_message = "Internal Server Error: {}: {}".format(type(e).__name__, str(e))
+            yield json.dumps({"stage": "error", "detail": error_message}) + "\n"
+
+    return StreamingResponse(stages(), media_type="application/x-ndjson")
+
+
+def warmup_search() -> None:
+    """
+    Run one dense search with a stored embedding as the query, so index and
+    embedding pages are loaded before workers fork. Runs no model, so no thread
+    pools are started.
+    """
+    if SHARD_URLS:
+        return
+    local_search(np.asarray(embeddings[0]), None, RagQuery(query=WARMUP_QUERY))
+
+
+def warmup() -> None:
+    """
+    Run one encode, search and rerank, so kernels, thread pools and index pages
+    are initialized before the first real request.
+    """
+    query = RagQuery(query=WARMUP_QUERY)
+    query_embedding = model.encode([transform_query(query.query)]).squeeze(0)
+    if SHARD_URLS:
+        candidates = [{"id": 0, "text": WARMUP_QUERY}]
+    else:
+        candidates, _ = local_search(query_embedding, None, query)
+    rerank(query, candidates)
+
+
+@app.on_event("startup")
+async def startup():
+    global ranker
+    ranker = timed("ranker", lambda: Ranker())
+    timed("warmup", warmup)
+
+
+@app.get("/ready")
+async def ready_probe():
+    """
+    Readiness probe. Uvicorn only accepts requests once the startup warmup has
+    finished, so any response means this worker is warmed up.
+    """
+    return {"ready": True, "pid": os.getpid(), "startup_ms": startup_timings}
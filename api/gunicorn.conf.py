@@ -0,0 +1,40 @@
+"""
+Gunicorn settings for serving api.py with several workers.
+
+The app is imported once in the parent process (preload_app), which loads the
+index, chunks and embedding model and touches the index pages with a search.
+Workers are then forked from it and share those pages copy-on-write, so adding
+a worker takes seconds (e.g. `kill -TTIN <parent pid>`). Each worker creates
+its own reranker and runs a full encode, search and rerank warmup before it
+accepts requests.
+
+Usage: gunicorn -c gunicorn.conf.py api:app
+"""
+
+import os
+import gc
+import torch
+
+bind = os.environ.get("BIND", "0.0.0.0:8000")
+workers = int(os.environ.get("WEB_CONCURRENCY", 2))
+worker_class = "uvicorn.workers.UvicornWorker"
+preload_app = True
+timeout = 120
+
+## OpenMP thread pools are not fork-safe: keep the parent single-threaded so that
+## loading the model never starts one, workers pick their thread count in post_fork
+torch.set_num_threads(1)
+
+
+def when_ready(server):
+    import api
+
+    api.timed("preload_warmup", api.warmup_search)
+    ## Keep the collector from touching (and so copying) the preloaded objects in workers
+    gc.freeze()
+    server.log.info(f"startup (ms): {api.startup_timings}")
+
+
+def post_fork(server, worker):
+    ## Split the cores between workers instead of every worker using all of them
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // workers))
@@ -9,6 +9,7 @@ import json
 from typing import List, Dict
 import glob
 from uuid import uuid4
+from datetime import date
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 
 text_splitter = RecursiveCharacterTextSplitter(
@@ -76,6 +77,7 @@ def chunk(documents: List[Dict]) -> List[List[Dict]]:
     {text} 
     """
     chunks = []
+    ingested_at = date.today().isoformat()
     for document in documents:
         if not isinstance(document, dict):
             raise TypeError("document must be a dictionary")
@@ -91,6 +93,9 @@ def chunk(documents: List[Dict]) -> List[List[Dict]]:
                 {
                     "chunk_id": str(uuid4()),
                     "document_id": document["id"],
+                    "title": document["meta"]["title"],
+                    "source": document["meta"].get("source", "unknown"),
+                    "ingested_at": ingested_at,
                     "chunk_text": full_text.format(**chunk_content),
                 }
             )
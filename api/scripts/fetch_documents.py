@@ -65,7 +65,11 @@ def search_and_retrieve(query: str) -> List[Dict]:
             {
                 "id": page.pageid,
                 "text": page.content,
-                "meta": {"title": page.title, "summary": page.summarize(chars=256)},
+                "meta": {
+                    "title": page.title,
+                    "summary": page.summarize(chars=256),
+                    "source": "wikipedia",
+                },
             }
             for page in pages
             if page is not None
@@ -1,28 +1,117 @@
 import sys
+import json
+from typing import List, Dict
 from tqdm import tqdm
 import numpy as np
 from usearch.index import Index
 
 EMBEDDING_DIM = 1024
 
-index = Index(
-    ndim=EMBEDDING_DIM,
-    metric="cos",
-    dtype="f32",
-    connectivity=16,
-    expansion_add=128,
-    expansion_search=64,
-    multi=False,
-)
-
-if len(sys.argv) < 3:
+
+def new_index() -> Index:
+    return Index(
+        ndim=EMBEDDING_DIM,
+        metric="cos",
+        dtype="f32",
+        connectivity=16,
+        expansion_add=128,
+        expansion_search=64,
+        multi=False,
+    )
+
+
+if len(sys.argv) < 4:
     print(
-        "Usage: python populate_index.py <embeddings_file> <output_folder> <output_file>"
+        "Usage: python populate_index.py <embeddings_file> <output_folder> <output_file> [chunks_file] [num_shards]"
     )
     exit(1)
 
+
+def build_metadata(chunks: List[Dict]) -> Dict[str, np.ndarray]:
+    """
+    Build the columnar metadata side table for the index, row i describes key i.
+
+    String columns are dictionary encoded, "source" and "title" hold codes into
+    the "sources" and "titles" vocabularies.
+
+    Parameters:
+        chunks (List[Dict]): The chunks, in the same order as the embeddings.
+
+    Returns:
+        Dict[str, np.ndarray]: The metadata columns.
+    """
+    sources, source_codes = np.unique(
+        [chunk.get("source", "unknown") for chunk in chunks], return_inverse=True
+    )
+    titles, title_codes = np.unique(
+        [chunk["title"] for chunk in chunks], return_inverse=True
+    )
+    return {
+        "document_id": np.array([chunk["document_id"] for chunk in chunks], dtype=np.int64),
+        "source": source_codes.astype(np.int32),
+        "sources": sources,
+        "title": title_codes.astype(np.int32),
+        "titles": titles,
+        "ingested_at": np.array(
+            [chunk["ingested_at"] for chunk in chunks], dtype="datetime64[D]"
+        ),
+    }
+
+
+def write_shards(
+    embeddings: np.ndarray, chunks: List[Dict], num_shards: int, output_path: str
+) -> None:
+    """
+    Partition the keys round-robin into num_shards shards and write each one as
+    <output_path>.shard<i>.{usearch,npy,meta.npz,chunks.json}, the files shard.py serves.
+
+    Shard indexes are keyed by row within the shard, the global key of every row
+    is kept in the "key" metadata column.
+
+    Parameters:
+        embeddings (np.ndarray): The embeddings, row i is key i, can be a memory map.
+        chunks (List[Dict]): The chunks, in the same order as the embeddings.
+        num_shards (int): The number of shards to write.
+        output_path (str): The output folder and file name prefix.
+    """
+    for shard in range(num_shards):
+        keys = np.arange(shard, len(embeddings), num_shards)
+        ## Only this shard's rows are read into memory
+        shard_embeddings = np.asarray(embeddings[keys])
+        shard_index = new_index()
+        for row, embedding in enumerate(tqdm(shard_embeddings, desc=f"shard {shard}")):
+            shard_index.add(row, embedding)
+        shard_index.save(f"{output_path}.shard{shard}.usearch")
+
+        shard_chunks = [chunks[key] for key in keys]
+        np.save(f"{output_path}.shard{shard}.npy", shard_embeddings)
+        np.savez(
+            f"{output_path}.shard{shard}.meta.npz",
+            key=keys.astype(np.int64),
+            **build_metadata(shard_chunks),
+        )
+        json.dump(shard_chunks, open(f"{output_path}.shard{shard}.chunks.json", "w"))
+
+
 if __name__ == "__main__":
-    embeddings = np.load(sys.argv[1])
-    for i, embedding in enumerate(tqdm(embeddings)):
-        index.add(i, embedding)
-    index.save(f"{sys.argv[2]}/{sys.argv[3]}.usearch")
+    output_path = f"{sys.argv[2]}/{sys.argv[3]}"
+    num_shards = int(sys.argv[5]) if len(sys.argv) > 5 else 1
+
+    if num_shards > 1:
+        ## Sharded corpora may not fit in memory, read the embeddings shard by shard
+        embeddings = np.load(sys.argv[1], mmap_mode="r")
+    else:
+        embeddings = np.load(sys.argv[1])
+        index = new_index()
+        for i, embedding in enumerate(tqdm(embeddings)):
+            index.add(i, embedding)
+        index.save(f"{output_path}.usearch")
+
+    if len(sys.argv) > 4:
+        chunks = json.load(open(sys.argv[4], "r"))
+        if len(chunks) != len(embeddings):
+            raise ValueError("chunks and embeddings have different lengths")
+        if num_shards > 1:
+            write_shards(embeddings, chunks, num_shards, output_path)
+        else:
+            np.savez(f"{output_path}.meta.npz", **build_metadata(chunks))
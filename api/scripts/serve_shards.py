@@ -0,0 +1,40 @@
+"""
+This script starts one shard.py server per shard written by populate_index.py, on consecutive local ports.
+It prints the SHARD_URLS value to start api.py with, and stops the shard servers on exit.
+Run it from the directory containing shard.py.
+"""
+
+import os
+import sys
+import subprocess
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print("Usage: python serve_shards.py <index_path> <num_shards> [base_port]")
+        exit(1)
+    index_path = sys.argv[1]
+    num_shards = int(sys.argv[2])
+    base_port = int(sys.argv[3]) if len(sys.argv) > 3 else 8100
+
+    processes = []
+    for shard in range(num_shards):
+        env = {**os.environ, "SHARD_PATH": f"{index_path}.shard{shard}"}
+        processes.append(
+            subprocess.Popen(
+                ["uvicorn", "shard:app", "--host", "127.0.0.1", "--port", str(base_port + shard)],
+                env=env,
+            )
+        )
+    urls = [f"http://127.0.0.1:{base_port + shard}" for shard in range(num_shards)]
+    print(f"SHARD_URLS={','.join(urls)}")
+
+    try:
+        for process in processes:
+            process.wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
@@ -0,0 +1,66 @@
+"""
+Shard server: serves dense search over one shard written by populate_index.py.
+The /retrieve/ endpoint in api.py fans out to these when SHARD_URLS is set.
+
+Usage: SHARD_PATH=data/indexes/index.shard0 uvicorn shard:app --port 8100
+"""
+
+from fastapi import FastAPI, HTTPException, status
+
+import os
+import json
+from typing import List, Optional
+import numpy as np
+from usearch.index import Index
+
+from utils import MetadataFilter, dense_search, metadata_mask
+
+SHARD_PATH = os.environ["SHARD_PATH"]
+
+index = Index.restore(f"{SHARD_PATH}.usearch")
+embeddings = np.load(f"{SHARD_PATH}.npy", mmap_mode="r")
+embedding_norms = np.linalg.norm(embeddings, axis=1)
+metadata = dict(np.load(f"{SHARD_PATH}.meta.npz"))
+chunks = json.load(open(f"{SHARD_PATH}.chunks.json", "r"))
+
+app = FastAPI(docs_url="/")
+
+
+class ShardQuery(MetadataFilter):
+    embedding: List[float]
+    count: int = 30
+    expansion_search: Optional[int] = None
+
+
+@app.post("/search/")
+async def search(query: ShardQuery):
+    try:
+        mask = metadata_mask(
+            metadata, **query.model_dump(include=set(MetadataFilter.model_fields))
+        )
+        results, search_info = dense_search(
+            index,
+            embeddings,
+            embedding_norms,
+            np.asarray(query.embedding, dtype=np.float32),
+            query.count,
+            expansion_search=query.expansion_search,
+            mask=mask,
+        )
+        return {
+            "results": [
+                {
+                    "key": int(metadata["key"][row]),
+                    "chunk_id": chunks[row]["chunk_id"],
+                    "distance": distance,
+                    "chunk_text": chunks[row]["chunk_text"],
+                }
+                for row, distance in results
+            ],
+            "search": search_info,
+        }
+    except Exception as e:
+        error_message = "Internal Server Error: {}: {}".format(type(e).__name__, str(e))
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=error_message
+        ) from e
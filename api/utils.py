@@ -1,5 +1,25 @@
 from pydantic import BaseModel, Field
-from typing import Any, Dict, Type
+from typing import Any, Dict, List, Optional, Tuple, Type
+from datetime import date
+
+import os
+import time
+import numpy as np
+from usearch.index import Index
+
+## Corpora at or below this many vectors are searched exactly with a matrix product,
+## larger ones go through the HNSW graph
+EXACT_SEARCH_THRESHOLD = int(os.environ.get("EXACT_SEARCH_THRESHOLD", 50_000))
+## Filtered HNSW searches over-fetch by the inverse of the filter selectivity, up to this many candidates
+MAX_FILTERED_COUNT = 4096
+
+
+class MetadataFilter(BaseModel):
+    document_ids: Optional[List[int]] = None
+    sources: Optional[List[str]] = None
+    titles: Optional[List[str]] = None
+    ingested_after: Optional[date] = None
+    ingested_before: Optional[date] = None
 
 
 def to_openai_tool(pydantic_class: Type[BaseModel]) -> Dict[str, Any]:
@@ -15,3 +35,156 @@ def to_openai_tool(pydantic_class: Type[BaseModel]) -> Dict[str, Any]:
 
 def transform_query(query: str) -> str:
     return f"Represent this sentence for searching relevant passages: {query}"
+
+
+def exact_search(
+    embeddings: np.ndarray,
+    norms: np.ndarray,
+    query_embedding: np.ndarray,
+    count: int,
+    rows: Optional[np.ndarray] = None,
+) -> List[Tuple[int, float]]:
+    """
+    Brute-force cosine search over the full embedding matrix.
+
+    The matrix can be a read-only memory map, scoring is a single matrix-vector
+    product so it goes through BLAS in one batch.
+
+    Args:
+        embeddings (np.ndarray): The (n, d) embedding matrix, row i is key i in the index.
+        norms (np.ndarray): The precomputed L2 norms of the embedding rows.
+        query_embedding (np.ndarray): The (d,) query embedding.
+        count (int): The number of results to return.
+        rows (Optional[np.ndarray]): Restrict the search to these keys, searches every row if None.
+
+    Returns:
+        List[Tuple[int, float]]: (key, cosine distance) pairs sorted by distance, same as usearch.
+    """
+    query_embedding = query_embedding.astype(embeddings.dtype, copy=False)
+    query_norm = np.linalg.norm(query_embedding)
+    if query_norm == 0:
+        raise ValueError("query embedding has zero norm")
+
+    if rows is None:
+        rows = np.arange(len(embeddings))
+        similarities = embeddings @ query_embedding
+    else:
+        similarities = embeddings[rows] @ query_embedding
+    similarities /= np.maximum(norms[rows] * query_norm, np.finfo(np.float32).eps)
+
+    count = min(count, len(similarities))
+    if count == 0:
+        return []
+    top = np.argpartition(-similarities, count - 1)[:count]
+    top = top[np.argsort(-similarities[top])]
+    return [(int(rows[i]), float(1.0 - similarities[i])) for i in top]
+
+
+def metadata_mask(
+    metadata: Dict[str, np.ndarray],
+    document_ids: Optional[List[int]] = None,
+    sources: Optional[List[str]] = None,
+    titles: Optional[List[str]] = None,
+    ingested_after: Optional[date] = None,
+    ingested_before: Optional[date] = None,
+) -> Optional[np.ndarray]:
+    """
+    Evaluate a filter against the columnar chunk metadata written by populate_index.py.
+
+    Args:
+        metadata (Dict[str, np.ndarray]): The metadata columns, row i describes key i in the index.
+        document_ids (Optional[List[int]]): Keep chunks from these documents.
+        sources (Optional[List[str]]): Keep chunks from these sources.
+        titles (Optional[List[str]]): Keep chunks from documents with these titles.
+        ingested_after (Optional[date]): Keep chunks ingested on or after this date.
+        ingested_before (Optional[date]): Keep chunks ingested on or before this date.
+
+    Returns:
+        Optional[np.ndarray]: A boolean mask over the keys, None if no filter was given.
+    """
+    mask = None
+
+    def restrict(condition: np.ndarray) -> None:
+        nonlocal mask
+        mask = condition if mask is None else mask & condition
+
+    if document_ids:
+        restrict(np.isin(metadata["document_id"], document_ids))
+    if sources:
+        codes = np.flatnonzero(np.isin(metadata["sources"], sources))
+        restrict(np.isin(metadata["source"], codes))
+    if titles:
+        codes = np.flatnonzero(np.isin(metadata["titles"], titles))
+        restrict(np.isin(metadata["title"], codes))
+    if ingested_after is not None:
+        restrict(metadata["ingested_at"] >= np.datetime64(ingested_after, "D"))
+    if ingested_before is not None:
+        restrict(metadata["ingested_at"] <= np.datetime64(ingested_before, "D"))
+    return mask
+
+
+def dense_search(
+    index: Index,
+    embeddings: np.ndarray,
+    norms: np.ndarray,
+    query_embedding: np.ndarray,
+    count: int,
+    expansion_search: Optional[int] = None,
+    mask: Optional[np.ndarray] = None,
+) -> Tuple[List[Tuple[int, float]], Dict]:
+    """
+    Search the corpus for the nearest chunks to the query embedding.
+
+    Small corpora, and filters that leave few enough chunks, are scored exactly
+    against the memory-mapped embeddings of the matching rows only. Everything
+    else is searched through the HNSW index, optionally with a per-request
+    expansion_search, over-fetching in proportion to the filter selectivity.
+    If a filtered HNSW search still returns fewer than count matches, the
+    matching rows are searched exactly instead, reported as "hnsw+exact".
+
+    Args:
+        index (Index): The HNSW index, key i is row i of embeddings.
+        embeddings (np.ndarray): The (n, d) embedding matrix.
+        norms (np.ndarray): The precomputed L2 norms of the embedding rows.
+        query_embedding (np.ndarray): The query embedding.
+        count (int): The number of results to return.
+        expansion_search (Optional[int]): HNSW search expansion, defaults to the index setting.
+        mask (Optional[np.ndarray]): Boolean mask of the keys allowed in the results.
+
+    Returns:
+        Tuple[List[Tuple[int, float]], Dict]: (key, distance) pairs and a description of the search.
+    """
+    start = time.perf_counter()
+    rows = None if mask is None else np.flatnonzero(mask)
+    candidates = len(embeddings) if rows is None else len(rows)
+    if candidates <= EXACT_SEARCH_THRESHOLD:
+        results = exact_search(embeddings, norms, query_embedding, count, rows=rows)
+        info = {"method": "exact"}
+    else:
+        fetch = count
+        if rows is not None:
+            selectivity = candidates / len(embeddings)
+            fetch = min(int(np.ceil(count / selectivity)), MAX_FILTERED_COUNT)
+        previous_expansion = index.expansion_search
+        index.expansion_search = max(expansion_search or previous_expansion, fetch)
+        try:
+            matches = index.search(query_embedding, count=fetch)
+            info = {"method": "hnsw", "expansion_search": index.expansion_search}
+        finally:
+            index.expansion_search = previous_expansion
+        if matches is None:
+            raise ValueError("search results are None")
+        results = [
+            (int(key), float(distance))
+            for key, distance in matches.to_list()
+            if mask is None or mask[key]
+        ][:count]
+        if rows is not None and len(results) < min(count, candidates):
+            ## The filter and the query are correlated, so the over-fetch came back short:
+            ## backfill with an exact search over the matching rows
+            info["hnsw_results"] = len(results)
+            results = exact_search(embeddings, norms, query_embedding, count, rows=rows)
+            info["method"] = "hnsw+exact"
+    info["candidates"] = candidates
+    info["search_ms"] = round((time.perf_counter() - start) * 1000, 3)
+    return results, info
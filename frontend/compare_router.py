@@ -0,0 +1,116 @@
+"""
+This script compares the local topic router against the LLM classifier on a set of labelled queries.
+It reports the accuracy and latency of the LLM classifier, the router alone, and the router with LLM fallback.
+The labelled queries file is a JSON list of {"query": str, "retrieval": bool}, a small built-in set is used if none is given.
+It needs the backend running at RETRIEVAL_URL and an OpenAI key (or a stand-in at OPENAI_BASE_URL).
+"""
+
+import sys
+import json
+import time
+import asyncio
+import statistics
+from typing import Dict, List, Tuple
+
+import gui
+
+LABELLED_QUERIES = [
+    {"query": "Why is my electricity bill so high this month?", "retrieval": True},
+    {"query": "How do I report a power outage in my area?", "retrieval": True},
+    {"query": "When will power be restored after the storm?", "retrieval": True},
+    {"query": "What can I do to use less energy in the winter?", "retrieval": True},
+    {"query": "How do I sign up for the solar program?", "retrieval": True},
+    {"query": "What should I do if I smell gas at home?", "retrieval": True},
+    {"query": "Is it safe to run a generator in my garage?", "retrieval": True},
+    {"query": "What are the new emissions rules for utilities?", "retrieval": True},
+    {"query": "Are electricity prices expected to rise next year?", "retrieval": True},
+    {"query": "What are the benefits of wind power?", "retrieval": True},
+    {"query": "Hi, how are you?", "retrieval": False},
+    {"query": "Thanks, that was helpful!", "retrieval": False},
+    {"query": "Can you write me a haiku about cats?", "retrieval": False},
+    {"query": "What is the capital of France?", "retrieval": False},
+    {"query": "Translate 'good morning' into Spanish.", "retrieval": False},
+    {"query": "Who are you?", "retrieval": False},
+    {"query": "Tell me a joke.", "retrieval": False},
+    {"query": "What's 17 times 23?", "retrieval": False},
+]
+
+
+def is_retrieval(label: str) -> bool:
+    return json.loads(label)["type"] == gui.QueryType.RETRIEVAL.value
+
+
+def summarize(name: str, correct: List[bool], latencies: List[float]) -> None:
+    latencies = sorted(latencies)
+    p95 = latencies[max(0, int(round(0.95 * len(latencies))) - 1)]
+    print(
+        f"{name:<22} accuracy {sum(correct) / len(correct):6.1%}   "
+        f"mean {statistics.mean(latencies) * 1000:8.1f} ms   p95 {p95 * 1000:8.1f} ms"
+    )
+
+
+def suggest_thresholds(scores: List[float], labels: List[bool]) -> Tuple[float, float]:
+    """
+    The narrowest ambiguous band that routes every labelled query correctly:
+    everything at or below low is a no retrieval query, everything at or above
+    high is a retrieval query.
+    """
+    retrieval = [score for score, label in zip(scores, labels) if label]
+    no_retrieval = [score for score, label in zip(scores, labels) if not label]
+    if not retrieval or not no_retrieval:
+        raise ValueError("the labelled queries need both retrieval and no retrieval examples")
+    low = min(retrieval) - 1e-3
+    high = max(no_retrieval) + 1e-3
+    if low >= high:
+        ## The classes separate, split the gap between them
+        low = high = (min(retrieval) + max(no_retrieval)) / 2
+    return low, high
+
+
+async def compare(queries: List[Dict]) -> None:
+    await gui.router.centroids()
+
+    llm, router, fallback = [], [], []
+    llm_latency, router_latency, fallback_latency = [], [], []
+    ambiguous = 0
+    scores = []
+    for example in queries:
+        start = time.perf_counter()
+        label = await gui.classifier(None, example["query"])
+        llm_latency.append(time.perf_counter() - start)
+        llm.append(is_retrieval(label) == example["retrieval"])
+
+        start = time.perf_counter()
+        retrieval, score = await gui.router.route(example["query"])
+        router_latency.append(time.perf_counter() - start)
+        scores.append(score)
+        ## Ambiguous scores are counted as retrieval for the router alone
+        router.append((retrieval is not False) == example["retrieval"])
+
+        if retrieval is None:
+            ambiguous += 1
+            start = time.perf_counter()
+            retrieval = is_retrieval(await gui.classifier(None, example["query"]))
+            fallback_latency.append(router_latency[-1] + time.perf_counter() - start)
+        else:
+            fallback_latency.append(router_latency[-1])
+        fallback.append(retrieval == example["retrieval"])
+        print(f"{score:.3f}  {example['retrieval']!s:<5}  {example['query']}")
+
+    print()
+    summarize("llm classifier", llm, llm_latency)
+    summarize("router", router, router_latency)
+    summarize("router + llm fallback", fallback, fallback_latency)
+    print(
+        f"thresholds low={gui.router.low} high={gui.router.high}, "
+        f"{ambiguous}/{len(queries)} queries fell back to the llm"
+    )
+    low, high = suggest_thresholds(scores, [example["retrieval"] for example in queries])
+    print(f"suggested ROUTER_LOW={low:.3f} ROUTER_HIGH={high:.3f}")
+
+
+if __name__ == "__main__":
+    queries = LABELLED_QUERIES
+    if len(sys.argv) > 1:
+        queries = json.load(open(sys.argv[1], "r"))
+    asyncio.run_coroutine_threadsafe(compare(queries), gui.loop).result()
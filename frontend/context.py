@@ -0,0 +1,168 @@
+"""
+Token-budgeted conversation context: recent turns verbatim, older turns folded
+into a running summary, plus the older turns most relevant to the new message.
+"""
+
+import os
+import math
+import asyncio
+from pydantic import BaseModel
+from typing import Awaitable, Callable, List, Optional
+
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("CONTEXT_TOKEN_BUDGET", 1500))
+RECENT_TURNS = int(os.environ.get("RECENT_TURNS", 3))
+RELEVANT_TURNS = int(os.environ.get("RELEVANT_TURNS", 2))
+## Turns folded into the summary per summarization call
+SUMMARY_BATCH = 8
+## Rough characters per token for English text, used to estimate prompt sizes
+CHARS_PER_TOKEN = 4
+
+
+def estimate_tokens(text: str) -> int:
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def truncate(text: str, tokens: int) -> str:
+    if tokens <= 0:
+        return ""
+    return text[: tokens * CHARS_PER_TOKEN]
+
+
+def cosine(a: List[float], b: List[float]) -> float:
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(x * x for x in b))
+    if norm == 0:
+        return 0.0
+    return sum(x * y for x, y in zip(a, b)) / norm
+
+
+class Turn(BaseModel):
+    human: str
+    ai: str
+    embedding: Optional[List[float]] = None
+
+    @property
+    def text(self) -> str:
+        return f"Human: \n {self.human}\n\n AI:{self.ai}"
+
+
+class ConversationContext:
+    """
+    Builds prompts for a conversation within a token budget.
+
+    The last recent_turns turns are kept verbatim. Turns older than that are
+    folded into a running summary as they leave the window, and embedded so the
+    relevant_turns most similar to a new message can be brought back verbatim.
+
+    Args:
+        - preamble: Text every prompt starts with.
+        - summarize: Coroutine function (summary, new turns text) -> updated summary.
+        - embed: Coroutine function returning the embedding of a text.
+        - budget: Token budget for the whole prompt, excluding the new message.
+        - recent_turns: Number of most recent turns kept verbatim.
+        - relevant_turns: Maximum number of older turns brought back by similarity.
+    """
+
+    def __init__(
+        self,
+        preamble: str,
+        summarize: Callable[[str, str], Awaitable[str]],
+        embed: Callable[[str], Awaitable[List[float]]],
+        budget: int = CONTEXT_TOKEN_BUDGET,
+        recent_turns: int = RECENT_TURNS,
+        relevant_turns: int = RELEVANT_TURNS,
+    ) -> None:
+        self.preamble = preamble
+        self.summarize = summarize
+        self.embed = embed
+        self.budget = budget
+        self.recent_turns = recent_turns
+        self.relevant_turns = relevant_turns
+        self.turns: List[Turn] = []
+        self.summary = ""
+        self.summarized = 0
+        self._compacting: Optional[asyncio.Lock] = None
+
+    def add_turn(self, human: str, ai: str) -> None:
+        self.turns.append(Turn(human=human, ai=ai))
+
+    @property
+    def older_turns(self) -> List[Turn]:
+        return self.turns[: max(0, len(self.turns) - self.recent_turns)]
+
+    @property
+    def recent(self) -> List[Turn]:
+        return self.turns[len(self.older_turns) :]
+
+    async def compact(self) -> None:
+        """
+        Summarize and embed the turns that left the recent window since the last call.
+        Concurrent calls wait for each other, so no turn is summarized twice.
+        """
+        if self._compacting is None:
+            self._compacting = asyncio.Lock()
+        async with self._compacting:
+            older = self.older_turns
+            while self.summarized < len(older):
+                batch = older[self.summarized : self.summarized + SUMMARY_BATCH]
+                embeddings = asyncio.gather(*[self.embed(turn.text) for turn in batch])
+                self.summary = await self.summarize(
+                    self.summary, "\n".join(turn.text for turn in batch)
+                )
+                for turn, embedding in zip(batch, await embeddings):
+                    turn.embedding = embedding
+                self.summarized += len(batch)
+
+    async def render(
+        self, message: str, message_embedding: Optional[List[float]] = None
+    ) -> str:
+        """
+        Build the prompt for a new message.
+
+        Recent turns take the budget first, newest first, then the summary,
+        then the older turns most similar to the message. This never calls the
+        LLM: older turns that compact() hasn't reached yet are left out.
+
+        Args:
+            - message: The user's new message.
+            - message_embedding: The embedding of the message. Without it, no
+              older turns are brought back.
+
+        Returns:
+            The prompt, ending with the new message.
+        """
+        remaining = self.budget - estimate_tokens(self.preamble)
+
+        recent = []
+        for turn in reversed(self.recent):
+            if estimate_tokens(turn.text) > remaining:
+                break
+            recent.insert(0, turn)
+            remaining -= estimate_tokens(turn.text)
+
+        summary = ""
+        header = "Summary of the earlier conversation: "
+        text = truncate(self.summary, remaining - estimate_tokens(header) - 1)
+        if text:
+            summary = f"{header}{text}\n\n"
+            remaining -= estimate_tokens(summary)
+
+        candidates = []
+        if message_embedding is not None:
+            candidates = sorted(
+                (turn for turn in self.older_turns if turn.embedding is not None),
+                key=lambda turn: cosine(turn.embedding, message_embedding),
+                reverse=True,
+            )
+        relevant = []
+        for turn in candidates[: self.relevant_turns]:
+            if estimate_tokens(turn.text) <= remaining:
+                relevant.append(turn)
+                remaining -= estimate_tokens(turn.text)
+        relevant = [t for t in self.older_turns if any(t is r for r in relevant)]
+
+        return (
+            self.preamble
+            + summary
+            + "".join(turn.text for turn in relevant + recent)
+            + f"Human: \n {message}\n\n AI:"
+        )
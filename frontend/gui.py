@@ -4,27 +4,53 @@ Adapted from https://github.com/Avaiga/demo-chatbot/
 
 import os
 import sys
+import time
+import queue
+import asyncio
+import threading
 
 from taipy.gui import Gui, State, notify
 import openai
+import httpx
 
 from enum import Enum
 from pydantic import BaseModel, Field
-from typing import Any, Dict, Type
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Type
 
-import requests
 import json
 
+from router import RETRIEVAL_TOPICS, TopicRouter
+from context import ConversationContext
+
 MODEL = "gpt-3.5-turbo-0125"
 api_key = ""  # add yours here
-
-client = openai.Client(api_key=api_key)
-context = "The following is a conversation with an AI assistant made by Avertra. The assistant is helpful, creative, clever, and very friendly.\n\nHuman: Hello, who are you?\nAI: I am an AI created by Avertra. How can I help you today? "
+RETRIEVAL_URL = os.environ.get("RETRIEVAL_URL", "http://localhost:8000")
+## Minimum seconds between table refreshes while an answer streams in
+STREAM_REFRESH_INTERVAL = 0.05
+
+## All LLM and backend calls run on this loop, so the pooled clients below keep
+## their keep-alive connections across turns. OPENAI_BASE_URL and RETRIEVAL_URL
+## can point them at local stand-ins.
+loop = asyncio.new_event_loop()
+threading.Thread(target=loop.run_forever, daemon=True).start()
+
+client = openai.AsyncClient(api_key=api_key or None)
+retrieval_client = httpx.AsyncClient(
+    base_url=RETRIEVAL_URL,
+    timeout=30.0,
+    limits=httpx.Limits(max_connections=20, max_keepalive_connections=10),
+)
+PREAMBLE = "The following is a conversation with an AI assistant made by Avertra. The assistant is helpful, creative, clever, and very friendly.\n\nHuman: Hello, who are you?\nAI: I am an AI created by Avertra. How can I help you today? "
+## Maximum length of the running summary of older turns
+SUMMARY_MAX_TOKENS = 256
+context = None
 conversation = {
     "Conversation": ["What is Avertra all about?", "Simplicity, Synergy, Innovation."]
 }
 current_user_message = ""
 past_conversations = []
+## ConversationContext of each past conversation, by conversation id
+past_contexts = []
 selected_conv = None
 selected_row = [1]
 
@@ -36,7 +62,7 @@ def on_init(state: State) -> None:
     Args:
         - state: The current state of the app.
     """
-    state.context = "The following is a conversation with an AI assistant made by Avertra. The assistant is helpful, creative, clever, and very friendly.\n\nHuman: Hello, who are you?\nAI: I am an AI created by Avertra. How can I help you today? "
+    state.context = new_context()
     state.conversation = {
         "Conversation": [
             "What is Avertra all about?",
@@ -45,6 +71,7 @@ def on_init(state: State) -> None:
     }
     state.current_user_message = ""
     state.past_conversations = []
+    state.past_contexts = []
     state.selected_conv = None
     state.selected_row = [1]
 
@@ -76,7 +103,7 @@ class Query(BaseModel):
     )
 
 
-def query_expansion(state: State, prompt: str) -> str:
+async def query_expansion(state: State, prompt: str) -> str:
     p_ = f"""
         You have access to chats with queries that are incoming from a user. 
         Your job is to extract the search queries that would help answer the user's query. 
@@ -91,8 +118,10 @@ def query_expansion(state: State, prompt: str) -> str:
         {prompt}
         Search Query:"""
     response = (
-        client.completions.create(
-            model="gpt-3.5-turbo-instruct", prompt=p_, max_tokens=128
+        (
+            await client.completions.create(
+                model="gpt-3.5-turbo-instruct", prompt=p_, max_tokens=128
+            )
         )
         .choices[0]
         .text
@@ -101,9 +130,10 @@ def query_expansion(state: State, prompt: str) -> str:
     return response
 
 
-def classifier(state: State, prompt: str) -> str:
+async def classifier(state: State, prompt: str) -> str:
 
     tools = [to_openai_tool(state, Query)]
+    topics = "\n        ".join(RETRIEVAL_TOPICS)
     p_ = f"""
         You have access to chats with queries that are incoming from a user. 
         Your job is to determine whether the user query requires retrieval or not.
@@ -111,30 +141,11 @@ def classifier(state: State, prompt: str) -> str:
         No Retrieval means that the user query is not relevant to the knowledge base, and thus you don't need extra search queries to answer the user's query. 
 
         Examples of topics that require retrieval:
-        Electricity billing
-        Energy consumption measurement
-        Energy efficiency programs
-        Energy conservation
-        Power outage reporting
-        Electricity restoration after outage
-        Scheduled maintenance outages
-        Reducing energy consumption during peak hours
-        Energy saving tips for winter
-        Energy usage patterns analysis
-        Renewable energy programs for consumers
-        Solar energy program enrollment
-        Benefits of renewable energy sources
-        Gas leak safety procedures
-        Power outage preparedness
-        Portable generator safety guidelines
-        Energy regulations
-        Environmental standards compliance in the energy sector
-        Updates on energy policies
-        Energy market trends
+        {topics}
 
         If the query relates to any of the topics above, return 1. If the query doesn't relate to any of the topics above, return 0.
         """
-    response = client.chat.completions.create(
+    response = await client.chat.completions.create(
         model=MODEL,
         messages=[
             {
@@ -175,98 +186,242 @@ def classifier(state: State, prompt: str) -> str:
         return outputs[0]
 
 
-def search_and_retrieve(state: State, query: str) -> str:
-    results = requests.post(
-        url="http://localhost:8000/retrieve/", json={"query": query}
+async def embed(text: str) -> List[float]:
+    response = await retrieval_client.post("/embed/", json={"query": text})
+    response.raise_for_status()
+    return response.json()["embedding"]
+
+
+router = TopicRouter(embed)
+## Embed the topics at startup rather than on the first message; if the backend
+## isn't up yet, they are embedded on first use instead
+asyncio.run_coroutine_threadsafe(router.centroids(), loop)
+
+
+async def summarize(summary: str, turns: str) -> str:
+    p_ = f"""
+        You maintain a running summary of a conversation between a user and an AI assistant.
+        Update the summary with the new turns below. Keep every fact, question and answer
+        that could matter later, drop pleasantries, and keep it short.
+        Current Summary:
+        {summary}
+        New Turns:
+        {turns}
+        Updated Summary:"""
+    response = (
+        (
+            await client.completions.create(
+                model="gpt-3.5-turbo-instruct",
+                prompt=p_,
+                max_tokens=SUMMARY_MAX_TOKENS,
+            )
+        )
+        .choices[0]
+        .text
     )
+
+    return response.strip()
+
+
+def new_context() -> ConversationContext:
+    return ConversationContext(PREAMBLE, summarize, embed)
+
+
+async def route(
+    state: State,
+    message: str,
+    prompt: str,
+    message_embedding: Optional[List[float]] = None,
+) -> str:
+    """
+    Label the user's message with the local topic router, falling back to the
+    LLM classifier when the router's score is ambiguous or the message can't
+    be embedded.
+
+    Args:
+        - state: The current state of the app.
+        - message: The user's message, scored by the router.
+        - prompt: The prompt with the conversation context, for the classifier.
+        - message_embedding: The embedding of the message, if already computed.
+
+    Returns:
+        The label, in the same format as classifier().
+    """
+    try:
+        retrieval, score = await router.route(message, message_embedding)
+    except httpx.HTTPError as e:
+        print(f"router failed, falling back to the classifier: {e}")
+        retrieval = None
+    if retrieval is None:
+        return await classifier(state, prompt)
+    query_type = QueryType.RETRIEVAL if retrieval else QueryType.NO_RETRIEVAL
+    return Query(type=query_type).model_dump_json()
+
+
+async def search_and_retrieve(state: State, query: str) -> Optional[List[str]]:
+    try:
+        results = await retrieval_client.post("/retrieve/", json={"query": query})
+    except httpx.HTTPError as e:
+        print(f"search_and_retrieve failed: {e}")
+        return None
     if results.status_code != 200:
         return None
     return results.json()["results"]
 
 
-def request(state: State, prompt: str) -> str:
+async def expand_and_retrieve(state: State, prompt: str) -> Optional[List[str]]:
+    search_query = await query_expansion(state, prompt)
+    print("search query: ", search_query)
+    results = await search_and_retrieve(state, search_query)
+    print("results: ", results)
+    return results
+
+
+async def answer_stream(
+    state: State, context: ConversationContext, message: str
+) -> AsyncIterator[str]:
+    """
+    Route the message, retrieve context if needed and stream the answer.
+
+    The prompt is built from the conversation context within its token budget.
+    Query expansion and retrieval start while the message is embedded, on the
+    prompt without the relevant older turns, and are cancelled if the query
+    turns out not to need retrieval. If the message can't be embedded, the
+    answer is given without the relevant older turns and routed by the LLM
+    classifier.
+
+    Args:
+        - state: The current state of the app.
+        - context: The conversation so far.
+        - message: The user's new message.
+
+    Yields:
+        The answer tokens, as they arrive.
     """
-    Send a prompt to the GPT-4 API and return the response.
+    retrieval = asyncio.create_task(
+        expand_and_retrieve(state, await context.render(message))
+    )
+    try:
+        try:
+            message_embedding = await embed(message)
+        except httpx.HTTPError as e:
+            print(f"embed failed, answering without the relevant turns: {e}")
+            message_embedding = None
+        prompt = await context.render(message, message_embedding)
+        if message_embedding is None:
+            label = await classifier(state, prompt)
+        else:
+            label = await route(state, message, prompt, message_embedding)
+        print(label)
+        results = None
+        if json.loads(label)["type"] == QueryType.RETRIEVAL.value:
+            results = await retrieval
+    finally:
+        retrieval.cancel()
+        ## Collect the speculative retrieval, so its cancellation or failure isn't left unretrieved
+        await asyncio.gather(retrieval, return_exceptions=True)
+
+    if results is not None:
+        results = "\n".join(results)
+        system_prompt = f"You are a helpful assistant created by Avertra, you have access to their knowledge base about energy utility. Use the following context to answer user queries. Answer only from the knowledge base. {results}"
+    else:
+        system_prompt = f"You are a helpful assistant created by Avertra, an energy utility company."
+
+    stream = await client.chat.completions.create(
+        messages=[
+            {
+                "role": "system",
+                "content": system_prompt,
+            },
+            {
+                "role": "user",
+                "content": f"{prompt}",
+            },
+        ],
+        model=MODEL,
+        stream=True,
+    )
+    async for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+
+
+def request(state: State, context: ConversationContext, message: str) -> Iterator[str]:
+    """
+    Send a message to the GPT-4 API and stream the response.
 
     Args:
         - state: The current state of the app.
-        - prompt: The prompt to send to the API.
+        - context: The conversation so far.
+        - message: The user's new message.
 
     Returns:
-        The response from the API.
+        The response tokens from the API, as they arrive.
     """
+    tokens = queue.Queue()
 
-    label = classifier(state, prompt)
-    print(label)
-
-    if json.loads(label)["type"] == QueryType.RETRIEVAL.value:
-        search_query = query_expansion(state, prompt)
-        print("search query: ", search_query)
-        results = search_and_retrieve(state, search_query)
-        print("results: ", results)
-        if results is not None:
-            results = "\n".join(results)
-            response = client.chat.completions.create(
-                messages=[
-                    {
-                        "role": "system",
-                        "content": f"You are a helpful assistant created by Avertra, you have access to their knowledge base about energy utility. Use the following context to answer user queries. Answer only from the knowledge base. {results}",
-                    },
-                    {
-                        "role": "user",
-                        "content": f"{prompt}",
-                    },
-                ],
-                model=MODEL,
-            )
-            return response.choices[0].message.content
-
-    if json.loads(label)["type"] == QueryType.NO_RETRIEVAL.value:
-        response = client.chat.completions.create(
-            messages=[
-                {
-                    "role": "system",
-                    "content": f"You are a helpful assistant created by Avertra, an energy utility company.",
-                },
-                {
-                    "role": "user",
-                    "content": f"{prompt}",
-                },
-            ],
-            model=MODEL,
-        )
-        return response.choices[0].message.content
+    async def pump() -> None:
+        try:
+            async for token in answer_stream(state, context, message):
+                tokens.put(token)
+        except Exception as e:
+            tokens.put(e)
+        finally:
+            tokens.put(None)
 
+    asyncio.run_coroutine_threadsafe(pump(), loop)
+    while (token := tokens.get()) is not None:
+        if isinstance(token, Exception):
+            raise token
+        yield token
 
-def update_context(state: State) -> None:
+
+def update_context(state: State, message: str) -> Iterator[str]:
     """
     Update the context with the user's message and the AI's response.
 
     Args:
         - state: The current state of the app.
+        - message: The user's message.
+
+    Yields:
+        The answer so far, each time new tokens arrive.
     """
-    state.context += f"Human: \n {state.current_user_message}\n\n AI:"
-    answer = request(state, state.context).replace("\n", "")
-    state.context += answer
-    state.selected_row = [len(state.conversation["Conversation"]) + 1]
-    return answer
+    context = state.context
+    answer = ""
+    for token in request(state, context, message):
+        answer += token.replace("\n", "")
+        yield answer
+    context.add_turn(message, answer)
+    state.context = context
 
 
 def send_message(state: State) -> None:
     """
-    Send the user's message to the API and update the context.
+    Send the user's message to the API and stream the answer into the conversation.
 
     Args:
         - state: The current state of the app.
     """
     notify(state, "info", "Sending message...")
-    answer = update_context(state)
-    conv = state.conversation._dict.copy()
-    conv["Conversation"] += [state.current_user_message, answer]
+    message = state.current_user_message
+    history = state.conversation._dict["Conversation"] + [message]
     state.current_user_message = ""
-    state.conversation = conv
+    state.conversation = {"Conversation": history + [""]}
+    state.selected_row = [len(history)]
+
+    last_refresh = 0.0
+    answer = ""
+    for answer in update_context(state, message):
+        if time.monotonic() - last_refresh >= STREAM_REFRESH_INTERVAL:
+            state.conversation = {"Conversation": history + [answer]}
+            last_refresh = time.monotonic()
+    state.conversation = {"Conversation": history + [answer]}
     notify(state, "success", "Response received!")
 
+    ## Summarize turns leaving the recent window in the background, the next turn doesn't wait for it
+    asyncio.run_coroutine_threadsafe(state.context.compact(), loop)
+
 
 def style_conv(state: State, idx: int, row: int) -> str:
     """
@@ -311,9 +466,11 @@ def reset_chat(state: State) -> None:
     state.past_conversations = state.past_conversations + [
         [len(state.past_conversations), state.conversation]
     ]
+    state.past_contexts = state.past_contexts + [state.context]
     state.conversation = {
         "Conversation": ["Who are you?", "Hi! I am GPT-4. How can I help you today?"]
     }
+    state.context = new_context()
 
 
 def tree_adapter(item: list) -> [str, str]:
@@ -342,10 +499,20 @@ def select_conv(state: State, var_name: str, value) -> None:
         value: [[id, conversation]]
     """
     state.conversation = state.past_conversations[value[0][0]][1]
-    state.context = "The following is a conversation with an AI assistant. The assistant is helpful, creative, clever, and very friendly.\n\nHuman: Hello, who are you?\nAI: I am an AI created by OpenAI. How can I help you today? "
-    for i in range(2, len(state.conversation["Conversation"]), 2):
-        state.context += f"Human: \n {state.conversation['Conversation'][i]}\n\n AI:"
-        state.context += state.conversation["Conversation"][i + 1]
+    context = state.past_contexts[value[0][0]]
+    if context is None:
+        context = new_context()
+        for i in range(2, len(state.conversation["Conversation"]), 2):
+            context.add_turn(
+                state.conversation["Conversation"][i],
+                state.conversation["Conversation"][i + 1],
+            )
+        ## Summarize the rebuilt history in the background, the next turn doesn't wait for it
+        asyncio.run_coroutine_threadsafe(context.compact(), loop)
+        contexts = list(state.past_contexts)
+        contexts[value[0][0]] = context
+        state.past_contexts = contexts
+    state.context = context
     state.selected_row = [len(state.conversation["Conversation"]) + 1]
 
 
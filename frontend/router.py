@@ -0,0 +1,111 @@
+"""
+Local query router: decides whether a query needs retrieval by comparing its
+embedding to pre-embedded retrieval topics, instead of asking an LLM every turn.
+"""
+
+import os
+import math
+import asyncio
+from typing import Awaitable, Callable, List, Optional, Tuple
+
+RETRIEVAL_TOPICS = [
+    "Electricity billing",
+    "Energy consumption measurement",
+    "Energy efficiency programs",
+    "Energy conservation",
+    "Power outage reporting",
+    "Electricity restoration after outage",
+    "Scheduled maintenance outages",
+    "Reducing energy consumption during peak hours",
+    "Energy saving tips for winter",
+    "Energy usage patterns analysis",
+    "Renewable energy programs for consumers",
+    "Solar energy program enrollment",
+    "Benefits of renewable energy sources",
+    "Gas leak safety procedures",
+    "Power outage preparedness",
+    "Portable generator safety guidelines",
+    "Energy regulations",
+    "Environmental standards compliance in the energy sector",
+    "Updates on energy policies",
+    "Energy market trends",
+]
+
+## Queries scoring at or above ROUTER_HIGH need retrieval, at or below ROUTER_LOW
+## they don't, anything in between is left to the LLM classifier
+ROUTER_LOW = float(os.environ.get("ROUTER_LOW", 0.55))
+ROUTER_HIGH = float(os.environ.get("ROUTER_HIGH", 0.70))
+
+
+def normalize(vector: List[float]) -> List[float]:
+    norm = math.sqrt(sum(x * x for x in vector))
+    if norm == 0:
+        raise ValueError("embedding has zero norm")
+    return [x / norm for x in vector]
+
+
+class TopicRouter:
+    """
+    Routes queries by cosine similarity to the closest retrieval topic.
+
+    Args:
+        - embed: Coroutine function returning the embedding of a text.
+        - topics: The retrieval topics, embedded once on first use.
+        - low: Scores at or below this don't need retrieval.
+        - high: Scores at or above this need retrieval.
+    """
+
+    def __init__(
+        self,
+        embed: Callable[[str], Awaitable[List[float]]],
+        topics: List[str] = RETRIEVAL_TOPICS,
+        low: float = ROUTER_LOW,
+        high: float = ROUTER_HIGH,
+    ) -> None:
+        if low > high:
+            raise ValueError("low must not be greater than high")
+        self.embed = embed
+        self.topics = topics
+        self.low = low
+        self.high = high
+        self._centroids: Optional[List[List[float]]] = None
+        self._lock = asyncio.Lock()
+
+    async def centroids(self) -> List[List[float]]:
+        """Embed the topics on first use and return their normalized embeddings."""
+        async with self._lock:
+            if self._centroids is None:
+                embeddings = await asyncio.gather(*[self.embed(t) for t in self.topics])
+                self._centroids = [normalize(e) for e in embeddings]
+        return self._centroids
+
+    async def score(self, query_embedding: List[float]) -> float:
+        """Cosine similarity between the query and its closest topic."""
+        query_embedding = normalize(query_embedding)
+        return max(
+            sum(q * c for q, c in zip(query_embedding, centroid))
+            for centroid in await self.centroids()
+        )
+
+    async def route(
+        self, query: str, query_embedding: Optional[List[float]] = None
+    ) -> Tuple[Optional[bool], float]:
+        """
+        Route a query.
+
+        Args:
+            - query: The user query.
+            - query_embedding: The query embedding, if already computed.
+
+        Returns:
+            True if the query needs retrieval, False if it doesn't, None if the
+            score is ambiguous, along with the score.
+        """
+        if query_embedding is None:
+            query_embedding = await self.embed(query)
+        score = await self.score(query_embedding)
+        if score >= self.high:
+            return True, score
+        if score <= self.low:
+            return False, score
+        return None, score
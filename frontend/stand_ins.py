@@ -0,0 +1,159 @@
+"""
+Local stand-ins for the OpenAI API and the retrieval backend, for exercising the chat pipeline in gui.py without either.
+Every stand-in call sleeps for a fixed delay, so running this script checks that a retrieval turn overlaps
+classification with query expansion and retrieval instead of running them back to back.
+Usage: python stand_ins.py [delay_seconds]
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+import hashlib
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+STAND_IN_PORT = int(os.environ.get("STAND_IN_PORT", 8765))
+STAND_IN_ANSWER = "This is a stand-in answer streamed word by word."
+STAND_IN_PASSAGE = "Report power outages through the outage hotline."
+EMBEDDING_DIM = 8
+delay = 0.5
+
+
+def stand_in_embedding(text: str) -> list:
+    digest = hashlib.sha256(text.encode()).digest()
+    return [b / 255 - 0.5 for b in digest[:EMBEDDING_DIM]]
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """Answers the OpenAI endpoints used by gui.py, plus /embed/ and /retrieve/."""
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+    def send_json(self, body: dict) -> None:
+        payload = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def stream_chat(self, model: str) -> None:
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        for word in STAND_IN_ANSWER.split(" "):
+            chunk = {
+                "id": "stand-in",
+                "object": "chat.completion.chunk",
+                "created": 0,
+                "model": model,
+                "choices": [
+                    {"index": 0, "delta": {"content": word + " "}, "finish_reason": None}
+                ],
+            }
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            self.wfile.flush()
+        self.wfile.write(b"data: [DONE]\n\n")
+
+    def do_POST(self) -> None:
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        if self.path == "/embed/":
+            return self.send_json({"embedding": stand_in_embedding(body["query"])})
+
+        time.sleep(delay)
+        if self.path == "/retrieve/":
+            return self.send_json({"results": [STAND_IN_PASSAGE]})
+        if self.path.endswith("/completions") and "prompt" in body:
+            return self.send_json(
+                {
+                    "id": "stand-in",
+                    "object": "text_completion",
+                    "created": 0,
+                    "model": body["model"],
+                    "choices": [
+                        {
+                            "index": 0,
+                            "text": "outage reporting",
+                            "finish_reason": "stop",
+                            "logprobs": None,
+                        }
+                    ],
+                }
+            )
+        if self.path.endswith("/chat/completions") and body.get("stream"):
+            return self.stream_chat(body["model"])
+        if self.path.endswith("/chat/completions"):
+            return self.send_json(
+                {
+                    "id": "stand-in",
+                    "object": "chat.completion",
+                    "created": 0,
+                    "model": body["model"],
+                    "choices": [
+                        {
+                            "index": 0,
+                            "finish_reason": "tool_calls",
+                            "message": {
+                                "role": "assistant",
+                                "content": None,
+                                "tool_calls": [
+                                    {
+                                        "id": "stand-in",
+                                        "type": "function",
+                                        "function": {
+                                            "name": "Query",
+                                            "arguments": json.dumps({"type": "1"}),
+                                        },
+                                    }
+                                ],
+                            },
+                        }
+                    ],
+                }
+            )
+        self.send_error(404)
+
+
+def serve() -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer(("127.0.0.1", STAND_IN_PORT), StandInHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+async def retrieval_turn(gui) -> str:
+    context = gui.new_context()
+    message = "How do I report an outage?"
+    return "".join([token async for token in gui.answer_stream(None, context, message)])
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        delay = float(sys.argv[1])
+    server = serve()
+    base_url = f"http://127.0.0.1:{STAND_IN_PORT}"
+    os.environ["OPENAI_BASE_URL"] = f"{base_url}/v1"
+    os.environ["RETRIEVAL_URL"] = base_url
+    os.environ["OPENAI_API_KEY"] = "stand-in"
+    ## Stand-in embeddings are random, so every query falls back to the stand-in classifier
+    os.environ["ROUTER_LOW"] = "-1"
+    os.environ["ROUTER_HIGH"] = "2"
+
+    import gui
+
+    asyncio.run_coroutine_threadsafe(gui.router.centroids(), gui.loop).result()
+    start = time.perf_counter()
+    answer = asyncio.run_coroutine_threadsafe(retrieval_turn(gui), gui.loop).result()
+    elapsed = time.perf_counter() - start
+    server.shutdown()
+    server.server_close()
+
+    ## Classification, expansion, retrieval and the answer each take one delay:
+    ## run back to back that is 4 delays, overlapped it is 3
+    print(f"answer: {answer.strip()!r}")
+    print(f"retrieval turn took {elapsed:.2f}s with {delay:.2f}s per call")
+    assert answer.strip() == STAND_IN_ANSWER, "unexpected answer"
+    assert elapsed < 3.5 * delay, "classification did not overlap with retrieval"
+    print("ok")